@@ -18,25 +18,25 @@
 # Global Imports ----
 import streamlit as st
 import pandas as pd
+import numpy as np
 import pydeck as pdk
 from datetime import date
-import os, sys, base64
+import os, sys, uuid
+from pathlib import Path
 from textwrap import dedent
 
 # Constants ----
 REPO_NAME = "FLIGHTSDASHBOARD"
 
-# Ensure the directory is correct... every time. ---
-for _ in range(5):
-    if not os.path.basename(os.getcwd()).lower() == REPO_NAME.lower():
-        os.chdir("..")
-    else:
-        break
+# Anchor all paths to the repo root, regardless of the working directory. ---
+# Falls back to two levels above `src/dashboard/`, in case the repo is renamed.
+PARENTS = Path(__file__).resolve().parents
+ROOT = next((p for p in PARENTS if p.name.lower() == REPO_NAME.lower()), PARENTS[2])
 
 
-# Ensure the current directory is in the system path. ---
-if not os.path.abspath(".") in sys.path:
-    sys.path.append(os.path.abspath("."))
+# Ensure the repo root is in the system path. ---
+if not str(ROOT) in sys.path:
+    sys.path.append(str(ROOT))
 
 
 # ------------------------------------------------------------------------------#
@@ -57,38 +57,114 @@ st.set_page_config(layout="wide")
 # ------------------------------------------------------------------------------#
 
 
-def load_data(path: str):
-    return pd.read_csv(path, header=0)
+def to_parquet(path: str):
+    # Convert the static CSV to Parquet on the first run (or whenever the CSV is
+    # updated), and reuse it thereafter
+    name = os.path.splitext(os.path.basename(path))[0]
+    pq_path = os.path.join(ROOT, "data", "processed", f"{name}.parquet")
+    stale = not os.path.exists(pq_path) or (
+        os.path.getmtime(path) > os.path.getmtime(pq_path)
+    )
+    if stale:
+        os.makedirs(os.path.dirname(pq_path), exist_ok=True)
+        # Write to a temp file and move it into place, so that concurrent or
+        # interrupted writes can never leave a partial file at `pq_path`.
+        # Created with `open()`, so it gets the usual umask-derived permissions.
+        tmp_path = f"{pq_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "xb") as f:
+                pd.read_csv(path, header=0, engine="pyarrow").to_parquet(f)
+            os.replace(tmp_path, pq_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    return pq_path
+
+
+def load_data(path: str, usecols: list = None, dtype: dict = None):
+    df = pd.read_parquet(to_parquet(path), columns=usecols)
+    return df if dtype is None else df.astype(dtype)
+
+
+@st.cache_data(persist="disk", show_spinner=False)
+def load_flights_data(path: str, mtime: float = None):
+    df = load_data(
+        path,
+        usecols=[
+            "number",
+            "firstseen",
+            "origin_country",
+            "origin_lat",
+            "origin_lng",
+            "destination_country",
+            "destination_lat",
+            "destination_lng",
+        ],
+        dtype={
+            "origin_country": "category",
+            "destination_country": "category",
+        },
+    )
+    # Keep as datetime64, truncated to the day in UTC (as per the source data)
+    df["firstseen"] = (
+        pd.to_datetime(df["firstseen"], utc=True).dt.tz_localize(None).dt.normalize()
+    )
+    # Sort by date, for quick slicing when filtering; see `slice_by_date()`
+    df = df.sort_values("firstseen", kind="stable").reset_index(drop=True)
+    return df
 
 
-# @st.cache_data
-def load_flights_data(path: str):
-    df = load_data(path)
-    df["firstseen"] = pd.to_datetime(df["firstseen"]).dt.strftime("%Y-%m-%d")
+@st.cache_data(persist="disk", show_spinner=False)
+def load_covid_data(path: str, mtime: float = None):
+    df = load_data(
+        path,
+        usecols=["Country", "Latitude", "Longitude", "date", "total_cases"],
+        dtype={"Country": "category"},
+    )
+    df["date"] = pd.to_datetime(df["date"], format="%d/%m/%Y")
+    # Drop rows which would render nothing on the map
+    df = df.dropna(subset=["Latitude", "Longitude"])
+    df = df[df["total_cases"].fillna(0) > 0]
+    # Sort by date, for quick slicing when filtering; see `slice_by_date()`
+    df = df.sort_values("date", kind="stable").reset_index(drop=True)
     return df
 
 
-# @st.cache_data
-def load_covid_data(path: str):
+@st.cache_data(persist="disk", show_spinner=False)
+def load_cars_data(path: str, mtime: float = None):
     df = load_data(path)
-    df["date"] = pd.to_datetime(df["date"], format="%d/%m/%Y").dt.strftime("%Y-%m-%d")
     return df
 
 
-# @st.cache_data
-def load_cars_data(path: str):
-    df = load_data(path)
-    return df
+def slice_by_date(df: pd.DataFrame, col: str, dt: date):
+    # Expects `df` to be sorted on `col`, as done when loading
+    dates = df[col].values
+    target = np.datetime64(dt, "D")
+    lo = np.searchsorted(dates, target, side="left")
+    hi = np.searchsorted(dates, target, side="right")
+    return df.iloc[lo:hi]
+
+
+@st.cache_data(show_spinner=False)
+def csv_to_bytes(data: pd.DataFrame):
+    return data.to_csv(index=False).encode()
 
 
-# @st.cache_data
-def download_csv(data: pd.DataFrame):
-    csv = data.to_csv(index=False)
-    b64 = base64.b64encode(csv.encode()).decode()
-    lnk = (
-        f'<a href="data:file/csv;base64,{b64}" download="flights.csv">Download CSV</a>'
+def round_coords(data: pd.DataFrame, cols: list, decimals: int = 4):
+    # Pydeck serialises every digit of the coordinates, so round them for the map
+    # only (4dp is ~10 metres), leaving full precision for the table & download
+    return data.round(dict.fromkeys(cols, decimals))
+
+
+def download_csv(data: pd.DataFrame, file_name: str = "flights.csv"):
+    st.download_button(
+        "Download CSV",
+        data=csv_to_bytes(data),
+        file_name=file_name,
+        mime="text/csv",
+        key=f"download_{file_name}",
     )
-    st.markdown(lnk, unsafe_allow_html=True)
 
 
 # ------------------------------------------------------------------------------#
@@ -103,14 +179,23 @@ def download_csv(data: pd.DataFrame):
 # ------------------------------------------------------------------------------#
 
 
+# Source files; their modified times are passed to the loaders only as part of
+# the cache key, so that an updated CSV is reloaded rather than served from disk
+FLIGHTS_PATH = str(ROOT / "data/external/flights-jan-mar-2020.csv")
+COVID_PATH = str(ROOT / "data/external/covid.csv")
+CARS_PATH = str(ROOT / "data/external/car-accidents.csv")
+
 # Load the flights data filter by date variable
-flightDF = load_flights_data("./data/external/flights-jan-mar-2020.csv")
+flightDF = load_flights_data(FLIGHTS_PATH, os.path.getmtime(FLIGHTS_PATH))
 
 # Load the COVID-19 data and filter by date variable
-covidDF = load_covid_data("./data/external/covid.csv")
+covidDF = load_covid_data(COVID_PATH, os.path.getmtime(COVID_PATH))
 
 # 2014 locations of car accidents in the UK
-carsDF = load_cars_data("./data/external/car-accidents.csv")
+carsDF = load_cars_data(CARS_PATH, os.path.getmtime(CARS_PATH))
+
+# Latest date for the slider; the flights are sorted, so no need to scan for it
+FLIGHTS_MAX_DATE = flightDF["firstseen"].iloc[-1].date()
 
 
 # ------------------------------------------------------------------------------#
@@ -191,135 +276,165 @@ st.markdown(
     ),
 )
 
-# Subheader
-st.subheader("Select Date")
-
-# Date
-date = st.slider(
-    " ",
-    value=date.fromisoformat("2020-01-01"),
-    format="DD/MMM/YY",
-    min_value=date.fromisoformat("2020-01-01"),
-    max_value=date.fromisoformat(flightDF["firstseen"].max()),
-)
-
-
-# Subheader
-st.subheader("Interactive Map")
 
-# Subheader
-st.markdown(
-    unsafe_allow_html=True,
-    body=dedent(
-        """
-        The below Map has the following features:
-        - The <span style="color: rgba(240, 100, 0, 40)">**orange**</span> colour indicates the DEPARTURE airport.
-        - The <span style="color: rgba(0, 200, 0, 100)">**green**</span> colour indicates the DESTINATION airport.
-        - The <span style="color: red">**red**</span> colour indicates countries with COVID hotspots, and<br>
-        the SIZE of the circle indicates the amount of cases.
-        """
-    ),
-)
-
-
-# ------------------------------------------------------------------------------#
-# Filter Data                                                                ####
-# ------------------------------------------------------------------------------#
-
-# Flights
-flightDF = flightDF[flightDF["firstseen"] == date.isoformat()]
-
-# Covid
-covidDF = covidDF[covidDF["date"] == date.isoformat()]
+def build_flights_deck():
+    # Set viewport for the deckgl map
+    view = pdk.ViewState(latitude=0, longitude=0, zoom=0.2)
+
+    # Set colours for the origin and destination ends of the arc
+    DESTINATION_COLOUR = [0, 255, 0, 40]
+    ORIGIN_COLOUR = [240, 100, 0, 40]
+
+    # Create the arc layer
+    arcLayer = pdk.Layer(
+        "ArcLayer",
+        data=None,
+        get_width=2,
+        get_source_position=["origin_lng", "origin_lat"],
+        get_target_position=["destination_lng", "destination_lat"],
+        get_tilt=15,
+        get_source_color=ORIGIN_COLOUR,
+        get_target_color=DESTINATION_COLOUR,
+        pickable=True,
+        auto_highlight=True,
+    )
 
+    # Configure the tooltip
+    TOOLTIP_TEXT = {"html": "{number} from {origin_country} to {destination_country}"}
+
+    # Create the scatter plot layer
+    covidLayer = pdk.Layer(
+        "ScatterplotLayer",
+        data=None,
+        pickable=False,
+        opacity=0.8,
+        stroked=True,
+        filled=True,
+        radius_scale=5,
+        radius_min_pixels=1,
+        radius_max_pixels=1000,
+        line_width_min_pixels=1,
+        get_position=["Longitude", "Latitude"],
+        get_radius="total_cases",
+        get_fill_color=[255, 0, 0],
+        get_line_color=[255, 0, 0],
+    )
 
-# ------------------------------------------------------------------------------#
-# Set Visual                                                                 ####
-# ------------------------------------------------------------------------------#
+    return pdk.Deck(
+        layers=[covidLayer, arcLayer],
+        initial_view_state=view,
+        map_style="mapbox://styles/mapbox/dark-v9",
+        tooltip=TOOLTIP_TEXT,
+    )
 
 
-# Set viewport for the deckgl map
-view = pdk.ViewState(latitude=0, longitude=0, zoom=0.2)
-
-# Set colours for the origin and destination ends of the arc
-DESTINATION_COLOUR = [0, 255, 0, 40]
-ORIGIN_COLOUR = [240, 100, 0, 40]
-
-# Create the arc layer
-arcLayer = pdk.Layer(
-    "ArcLayer",
-    data=flightDF,
-    get_width=2,
-    get_source_position=["origin_lng", "origin_lat"],
-    get_target_position=["destination_lng", "destination_lat"],
-    get_tilt=15,
-    get_source_color=ORIGIN_COLOUR,
-    get_target_color=DESTINATION_COLOUR,
-    pickable=True,
-    auto_highlight=True,
-)
+@st.fragment
+def flights_panel(flightDF: pd.DataFrame, covidDF: pd.DataFrame):
+    # Subheader
+    st.subheader("Select Date")
 
-# Configure the tooltip
-TOOLTIP_TEXT = {"html": "{number} from {origin_country} to {destination_country}"}
-
-# Create the scatter plot layer
-covidLayer = pdk.Layer(
-    "ScatterplotLayer",
-    data=covidDF,
-    pickable=False,
-    opacity=0.8,
-    stroked=True,
-    filled=True,
-    radius_scale=5,
-    radius_min_pixels=1,
-    radius_max_pixels=1000,
-    line_width_min_pixels=1,
-    get_position=["Longitude", "Latitude"],
-    get_radius="total_cases",
-    get_fill_color=[255, 0, 0],
-    get_line_color=[255, 0, 0],
-)
+    # Date
+    dt = st.slider(
+        " ",
+        value=date.fromisoformat("2020-01-01"),
+        format="DD/MMM/YY",
+        min_value=date.fromisoformat("2020-01-01"),
+        max_value=FLIGHTS_MAX_DATE,
+    )
 
+    # Subheader
+    st.subheader("Interactive Map")
+
+    # Subheader
+    st.markdown(
+        unsafe_allow_html=True,
+        body=dedent(
+            """
+            The below Map has the following features:
+            - The <span style="color: rgba(240, 100, 0, 40)">**orange**</span> colour indicates the DEPARTURE airport.
+            - The <span style="color: rgba(0, 200, 0, 100)">**green**</span> colour indicates the DESTINATION airport.
+            - The <span style="color: red">**red**</span> colour indicates countries with COVID hotspots, and<br>
+            the SIZE of the circle indicates the amount of cases.
+            """
+        ),
+    )
 
-# Render the map in the Streamlit app as a Pydeck chart
-map = st.pydeck_chart(
-    pdk.Deck(
-        layers=[covidLayer, arcLayer],
-        initial_view_state=view,
-        map_style="mapbox://styles/mapbox/dark-v9",
-        tooltip=TOOLTIP_TEXT,
+    # --------------------------------------------------------------------------#
+    # Filter Data                                                            ####
+    # --------------------------------------------------------------------------#
+
+    # Flights
+    flightDF = slice_by_date(flightDF, "firstseen", dt)
+
+    # Covid
+    covidDF = slice_by_date(covidDF, "date", dt)
+
+    # --------------------------------------------------------------------------#
+    # Set Visual                                                             ####
+    # --------------------------------------------------------------------------#
+
+    # Build the deck once per session, then only swap in the data for the date.
+    # Not shared via `st.cache_resource`, as sessions would overwrite its data.
+    if "flights_deck" not in st.session_state:
+        st.session_state["flights_deck"] = build_flights_deck()
+    deck = st.session_state["flights_deck"]
+    covidLayer, arcLayer = deck.layers
+    # Only send the columns the layers & tooltip use; the dates would otherwise be
+    # serialised by pydeck as empty `{}` objects
+    covidLayer.data = round_coords(
+        covidDF[["Longitude", "Latitude", "total_cases"]], ["Longitude", "Latitude"]
+    )
+    arcLayer.data = round_coords(
+        flightDF[
+            [
+                "number",
+                "origin_country",
+                "origin_lat",
+                "origin_lng",
+                "destination_country",
+                "destination_lat",
+                "destination_lng",
+            ]
+        ],
+        ["origin_lat", "origin_lng", "destination_lat", "destination_lng"],
     )
-)
 
-# Protips
-st.markdown(
-    unsafe_allow_html=True,
-    body=dedent(
-        """
-        **ProTips:**
+    # Render the map in the Streamlit app as a Pydeck chart
+    map = st.pydeck_chart(deck)
+
+    # Protips
+    st.markdown(
+        unsafe_allow_html=True,
+        body=dedent(
+            """
+            **ProTips:**
+
+            1. <img src="https://icons-for-free.com/iconfiles/png/512/move-1321215623357277485.png" width=30></img> To pan : `click` & drag
+            2. <img src="https://icons-for-free.com/iconfiles/png/512/zoom+icon-1320166878528919604.png" width=30></img>To zoom: `scroll` up & down
+            3. <img src="https://icons-for-free.com/iconfiles/png/512/rotate+icon-1320166903129623074.png" width=30></img> To rotate: `ctrl`+`click` & drag
+            """
+        ),
+    )
 
-        1. <img src="https://icons-for-free.com/iconfiles/png/512/move-1321215623357277485.png" width=30></img> To pan : `click` & drag
-        2. <img src="https://icons-for-free.com/iconfiles/png/512/zoom+icon-1320166878528919604.png" width=30></img>To zoom: `scroll` up & down
-        3. <img src="https://icons-for-free.com/iconfiles/png/512/rotate+icon-1320166903129623074.png" width=30></img> To rotate: `ctrl`+`click` & drag
-        """
-    ),
-)
+    # Subheader
+    st.subheader("To see the raw data, check:")
 
-# Subheader
-st.subheader("To see the raw data, check:")
+    # Add Flights data
+    if st.checkbox("See Flights Data"):
+        download_csv(flightDF)
+        st.write("Flights on %s" % dt.strftime("%d/%b/%y"))
+        st.dataframe(flightDF, height=300)
 
-# Add Flights data
-if st.checkbox("See Flights Data"):
-    download_csv(flightDF)
-    st.write("Flights on %s" % date.strftime("%d/%b/%y"))
-    st.write(flightDF.head())
+    # Add Covid data
+    if st.checkbox("See Covid data"):
+        download_csv(covidDF, "covid.csv")
+        st.write("COVID-19 data on %s" % dt.strftime("%d/%b/%y"))
+        st.dataframe(covidDF, height=300)
 
-# Add Covid data
-if st.checkbox("See Covid data"):
-    download_csv(covidDF)
-    st.write("COVID-19 data on %s" % date.strftime("%d/%b/%y"))
-    st.write(covidDF.head())
 
+# Render the flights section as a fragment, so that moving the date slider
+# only re-runs this section, and not the whole page
+flights_panel(flightDF, covidDF)
 
 # Break
 st.write("---")
@@ -358,35 +473,42 @@ st.markdown(
     ),
 )
 
-# Define a layer to display on a map
-layer = pdk.Layer(
-    "HexagonLayer",
-    "https://raw.githubusercontent.com/uber-common/deck.gl-data/master/examples/3d-heatmap/heatmap-data.csv",
-    get_position=["lng", "lat"],
-    auto_highlight=True,
-    elevation_scale=50,
-    pickable=True,
-    elevation_range=[0, 3000],
-    extruded=True,
-    coverage=1,
-)
 
-# Set the viewport location
-# A deck.gl Viewport is essentially a geospatially enabled camera,
-# and combines a number of responsibilities, which can project and
-# unproject 3D coordinates to the screen.
-view_state = pdk.ViewState(
-    longitude=-1.415,
-    latitude=52.2323,
-    zoom=6,
-    min_zoom=5,
-    max_zoom=15,
-    pitch=40.5,
-    bearing=-27.36,
-)
+# Build the deck once; its inputs never change between reruns
+@st.cache_resource
+def build_uber_deck():
+    # Define a layer to display on a map
+    layer = pdk.Layer(
+        "HexagonLayer",
+        "https://raw.githubusercontent.com/uber-common/deck.gl-data/master/examples/3d-heatmap/heatmap-data.csv",
+        get_position=["lng", "lat"],
+        auto_highlight=True,
+        elevation_scale=50,
+        pickable=True,
+        elevation_range=[0, 3000],
+        extruded=True,
+        coverage=1,
+    )
+
+    # Set the viewport location
+    # A deck.gl Viewport is essentially a geospatially enabled camera,
+    # and combines a number of responsibilities, which can project and
+    # unproject 3D coordinates to the screen.
+    view_state = pdk.ViewState(
+        longitude=-1.415,
+        latitude=52.2323,
+        zoom=6,
+        min_zoom=5,
+        max_zoom=15,
+        pitch=40.5,
+        bearing=-27.36,
+    )
+
+    return pdk.Deck(initial_view_state=view_state, layers=[layer])
+
 
 # Render the map in Streamlit map
-deckchart = st.pydeck_chart(pdk.Deck(initial_view_state=view_state, layers=[layer]))
+deckchart = st.pydeck_chart(build_uber_deck())
 
 # Protips
 st.markdown(
@@ -407,6 +529,6 @@ st.subheader("To see the raw data, check:")
 
 # Add Cars data
 if st.checkbox("See Accidents Data"):
-    download_csv(carsDF)
+    download_csv(carsDF, "accidents.csv")
     st.write("Uber Accidents data")
-    st.write(carsDF.head())
+    st.dataframe(carsDF.head())